@@ -1,9 +1,13 @@
 import hashlib
+import json
 import logging
+import mmap
 import os
+import random
 import re
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import RotatingFileHandler
 
 import pyodbc
@@ -12,41 +16,78 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+# pyodbc default, stated explicitly: ODBC connection pooling is on
+pyodbc.pooling = True
+
+# Database settings, read once from the environment
+DB_SERVER = os.getenv("DB_SERVER")
+DB_DATABASE = os.getenv("DB_DATABASE")
+DB_USERNAME = os.getenv("DB_USERNAME")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_PORT = os.getenv("DB_PORT")
+DB_SETTINGS_PRESENT = all([DB_SERVER, DB_DATABASE, DB_USERNAME, DB_PASSWORD])
+
+DB_CONNECTION_STRING = (
+    f"DRIVER={{ODBC Driver 17 for SQL Server}};"
+    f"SERVER={DB_SERVER},{DB_PORT};"
+    f"DATABASE={DB_DATABASE};"
+    f"UID={DB_USERNAME};"
+    f"PWD={DB_PASSWORD}"
+)
+
 # Directory where your stored procedure .sql files are located
 SP_SCRIPTS_DIR = "sql/stored_procedures"
 
 # Table to store deployment metadata
 DEPLOYMENT_METADATA_TABLE = "CUSTOM_StoredProcedureDeploymentMetadata"
 
+# Change-detection hash: BLAKE2b with a 32-byte digest fits script_hash VARCHAR(64)
+HASH_DIGEST_SIZE = 32
+HASH_ALGORITHM = f"blake2b-{HASH_DIGEST_SIZE * 8}"
+
+# Files up to this size (64 KiB) are hashed from a single read
+SMALL_FILE_HASH_LIMIT = 1 << 16
+
+# Read size used when hashing script files (1 MiB)
+HASH_CHUNK_SIZE = 1 << 20
+
+# Batch separator: "GO" alone on its own line
+GO_SEPARATOR_RE = re.compile(r"^\s*GO\s*$", re.IGNORECASE)
+
+# Local cache of file hashes keyed on path, size and mtime
+HASH_CACHE_FILE = os.path.join(os.path.dirname(SP_SCRIPTS_DIR), ".deploy_cache.json")
+
+# Worker threads used to hash script files concurrently
+HASH_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
 # Setup logging
 LOG_FILE = "logs/deployment.log"
 # Ensure the log folder exists
 log_dir = os.path.dirname(LOG_FILE)
-if log_dir and not os.path.exists(log_dir):
+if log_dir:
     os.makedirs(log_dir, exist_ok=True)
 
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.FileHandler(LOG_FILE, encoding="utf-8"), logging.StreamHandler()],
+    handlers=[
+        RotatingFileHandler(
+            LOG_FILE, maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8"
+        ),
+        logging.StreamHandler(),
+    ],
 )
 
 
 def get_db_connection():
     """Establishes and returns a database connection."""
-    server = os.getenv("DB_SERVER")
-    database = os.getenv("DB_DATABASE")
-    username = os.getenv("DB_USERNAME")
-    password = os.getenv("DB_PASSWORD")
-    port = os.getenv("DB_PORT")
-
     # Add this print statement for debugging
     logging.info(
-        f"Attempting to connect with: Server={server}, User={username}, DB={database}, Port={port}"
+        f"Attempting to connect with: Server={DB_SERVER}, User={DB_USERNAME}, DB={DB_DATABASE}, Port={DB_PORT}"
     )
 
-    if not all([server, database, username, password]):
+    if not DB_SETTINGS_PRESENT:
         logging.error(
             "Database connection environment variables must be set: "
             "DB_SERVER, DB_DATABASE, DB_USERNAME, DB_PASSWORD, DB_PORT"
@@ -54,19 +95,14 @@ def get_db_connection():
         sys.exit(1)
 
     max_retries = 10
-    retry_delay = 5  # seconds
-
-    cnxn_str = (
-        f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-        f"SERVER={server},{port};"
-        f"DATABASE={database};"
-        f"UID={username};"
-        f"PWD={password}"
-    )
+    # 0.25s doubling to 8s: at most ~45s of waiting across all attempts
+    base_retry_delay = 0.25  # seconds
+    max_retry_delay = 8  # seconds
 
     for i in range(max_retries):
         try:
-            cnxn = pyodbc.connect(cnxn_str)
+            # pyodbc default, stated explicitly: callers commit or roll back
+            cnxn = pyodbc.connect(DB_CONNECTION_STRING, autocommit=False)
             logging.info("Successfully connected to the database.")
             return cnxn
         except pyodbc.Error as ex:
@@ -74,25 +110,123 @@ def get_db_connection():
             logging.warning(
                 f"Attempt {i+1}/{max_retries}: Database connection error: {ex}"
             )
-            time.sleep(retry_delay)
+            # No point waiting after the final attempt
+            if i == max_retries - 1:
+                break
+            # Exponential backoff with jitter, capped at max_retry_delay
+            delay = min(max_retry_delay, base_retry_delay * 2**i)
+            time.sleep(delay + random.uniform(0, 0.5))
 
     # This line is only reached if the loop completes without returning
     logging.error("Failed to connect to the database after multiple retries.")
     sys.exit(1)
 
 
+def new_hasher():
+    """Returns a fresh hash object for HASH_ALGORITHM."""
+    return hashlib.blake2b(digest_size=HASH_DIGEST_SIZE)
+
+
 def calculate_file_hash(filepath):
-    """Calculates the SHA256 hash of a file's content."""
-    hasher = hashlib.sha256()
+    """Calculates the BLAKE2b-256 hash of a file's content."""
     with open(filepath, "rb") as f:
-        while chunk := f.read(8192):
+        size = os.fstat(f.fileno()).st_size
+
+        # Small files (including empty ones, which mmap rejects) in one read
+        if size <= SMALL_FILE_HASH_LIMIT:
+            hasher = new_hasher()
+            hasher.update(f.read())
+            return hasher.hexdigest()
+
+        # Hash larger files as one mapped buffer
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                hasher = new_hasher()
+                hasher.update(memoryview(mm))
+                return hasher.hexdigest()
+        except (OSError, ValueError):
+            pass
+
+        # Fall back to a chunked read if the file cannot be mapped
+        hasher = new_hasher()
+        while chunk := f.read(HASH_CHUNK_SIZE):
             hasher.update(chunk)
     return hasher.hexdigest()
 
 
-def ensure_metadata_table_exists(cursor, cnxn):
-    """Checks if the deployment metadata table exists and creates it if not."""
-    create_table_sql = f"""
+def load_hash_cache():
+    """Loads the local file hash cache, returning an empty cache if unavailable."""
+    try:
+        with open(HASH_CACHE_FILE, "r", encoding="utf-8") as f:
+            hash_cache = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as ex:
+        logging.warning(f"Ignoring unreadable hash cache '{HASH_CACHE_FILE}': {ex}")
+        return {}
+    if not isinstance(hash_cache, dict):
+        logging.warning(
+            f"Ignoring unreadable hash cache '{HASH_CACHE_FILE}': expected an object"
+        )
+        return {}
+    return hash_cache
+
+
+def save_hash_cache(hash_cache):
+    """Writes the local file hash cache back to disk."""
+    try:
+        with open(HASH_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(hash_cache, f, indent=2, sort_keys=True)
+    except OSError as ex:
+        logging.warning(f"Could not write hash cache '{HASH_CACHE_FILE}': {ex}")
+
+
+def lookup_cached_hash(entry, hash_cache):
+    """Returns the cached hash for a file if its size and mtime are unchanged."""
+    try:
+        st = entry.stat()
+    except OSError:
+        return None
+    cached = hash_cache.get(entry.path)
+    # Malformed entries are treated as a cache miss
+    if (
+        isinstance(cached, dict)
+        and cached.get("algorithm") == HASH_ALGORITHM
+        and cached.get("size") == st.st_size
+        and cached.get("mtime_ns") == st.st_mtime_ns
+    ):
+        return cached.get("hash")
+    return None
+
+
+def get_cached_file_hash(entry, hash_cache):
+    """Returns the cached hash if size and mtime are unchanged, else rehashes."""
+    cached_hash = lookup_cached_hash(entry, hash_cache)
+    if cached_hash is not None:
+        return cached_hash
+    return hash_and_cache_file(entry, hash_cache)
+
+
+def hash_and_cache_file(entry, hash_cache):
+    """Hashes a file unconditionally and records it in the cache."""
+    st = entry.stat()
+    file_hash = calculate_file_hash(entry.path)
+    hash_cache[entry.path] = {
+        "algorithm": HASH_ALGORITHM,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "hash": file_hash,
+    }
+    return file_hash
+
+
+def get_deployed_hashes(cursor, cnxn):
+    """Ensures the metadata table exists and fetches deployed script hashes.
+
+    Table creation and the SELECT are sent as a single batch (one round-trip).
+    """
+    setup_and_select_sql = f"""
+    SET NOCOUNT ON;
     IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='{DEPLOYMENT_METADATA_TABLE}' and xtype='U')
     CREATE TABLE {DEPLOYMENT_METADATA_TABLE} (
         script_name VARCHAR(255) PRIMARY KEY,
@@ -100,32 +234,27 @@ def ensure_metadata_table_exists(cursor, cnxn):
         deployment_timestamp DATETIME DEFAULT GETDATE(),
         last_updated_timestamp DATETIME DEFAULT GETDATE()
     );
+    SELECT script_name, script_hash FROM {DEPLOYMENT_METADATA_TABLE};
     """
     try:
-        cursor.execute(create_table_sql)
+        cursor.execute(setup_and_select_sql)
+        # Advance past any non-row results to the SELECT's result set
+        while cursor.description is None and cursor.nextset():
+            pass
+        # Build the dict row by row from the cursor; no fetchall() list
+        deployed_hashes = {row.script_name: row.script_hash for row in cursor}
         cnxn.commit()
         logging.info(f"Ensured '{DEPLOYMENT_METADATA_TABLE}' table exists.")
     except pyodbc.Error as ex:
-        logging.error(f"Error ensuring metadata table exists: {ex}")
+        logging.error(f"Error preparing deployment metadata: {ex}")
         sys.exit(1)
-
-
-def get_deployed_hashes(cursor):
-    """Fetches the names and hashes of currently deployed scripts from the database."""
-    deployed_hashes = {}
-    try:
-        cursor.execute(
-            f"SELECT script_name, script_hash FROM {DEPLOYMENT_METADATA_TABLE}"
-        )
-        for row in cursor.fetchall():
-            deployed_hashes[row.script_name] = row.script_hash
-    except pyodbc.Error as ex:
-        logging.warning(f"Error fetching deployed hashes (may be first run): {ex}")
     return deployed_hashes
 
 
-def update_deployment_metadata(cursor, cnxn, script_name, new_hash):
-    """Inserts or updates the deployment metadata for a script."""
+def update_deployment_metadata(cursor, cnxn, metadata_rows):
+    """Inserts or updates the deployment metadata for a batch of scripts."""
+    if not metadata_rows:
+        return
     try:
         merge_sql = f"""
         MERGE {DEPLOYMENT_METADATA_TABLE} AS target
@@ -137,81 +266,139 @@ def update_deployment_metadata(cursor, cnxn, script_name, new_hash):
             INSERT (script_name, script_hash, deployment_timestamp, last_updated_timestamp)
             VALUES (source.script_name, source.script_hash, GETDATE(), GETDATE());
         """
-        cursor.execute(merge_sql, (script_name, new_hash))
+        # Send all rows in one round-trip instead of one MERGE per script
+        cursor.fast_executemany = True
+        cursor.executemany(merge_sql, metadata_rows)
         cnxn.commit()
-        logging.info(f"Metadata updated for {script_name}.")
+        logging.info(f"Metadata updated for {len(metadata_rows)} scripts.")
     except pyodbc.Error as ex:
-        logging.error(f"Error updating metadata for {script_name}: {ex}")
+        logging.error(f"Error updating deployment metadata: {ex}")
         sys.exit(1)
 
 
+def iter_statements(file):
+    """Yields the GO-separated statements of a script, one at a time."""
+    buf = []
+    for line in file:
+        # Split only on "GO" at line breaks
+        if GO_SEPARATOR_RE.match(line):
+            stmt = "".join(buf).strip()
+            if stmt:
+                yield stmt
+            buf = []
+        else:
+            buf.append(line)
+    stmt = "".join(buf).strip()
+    if stmt:
+        yield stmt
+
+
 def deploy_stored_procedures():
     """Main function to deploy stored procedures."""
     cnxn = get_db_connection()
     cursor = cnxn.cursor()
 
-    ensure_metadata_table_exists(cursor, cnxn)
-    deployed_hashes = get_deployed_hashes(cursor)
+    deployed_hashes = get_deployed_hashes(cursor, cnxn)
 
     deployed_count = 0
     skipped_count = 0
     error_count = 0
+    metadata_rows = []
 
     if not os.path.exists(SP_SCRIPTS_DIR):
         logging.error(f"Stored procedures directory '{SP_SCRIPTS_DIR}' not found.")
         sys.exit(1)
 
-    for filename in os.listdir(SP_SCRIPTS_DIR):
-        if filename.endswith(".sql"):
-            script_name = os.path.splitext(filename)[0]
-            filepath = os.path.join(SP_SCRIPTS_DIR, filename)
-
-            try:
-                local_hash = calculate_file_hash(filepath)
-
-                if (
-                    script_name in deployed_hashes
-                    and deployed_hashes[script_name] == local_hash
-                ):
-                    logging.info(f"Skipping '{filename}': No changes detected.")
-                    skipped_count += 1
-                    continue
-
-                logging.info(f"Deploying '{filename}' (New or changed).")
-                with open(filepath, "r", encoding="utf-8-sig") as file:
-                    sql_script_content = file.read()
-
-                # Split only on "GO" at line breaks
-                statements = [
-                    stmt.strip()
-                    for stmt in re.split(r"(?im)^\s*GO\s*$", sql_script_content)
-                    if stmt.strip()
-                ]
-
-                for i, stmt in enumerate(statements, 1):
+    # is_file() uses the file type from the directory read, avoiding a stat;
+    # entry.stat() results are cached on the DirEntry for the hash cache
+    with os.scandir(SP_SCRIPTS_DIR) as it:
+        sql_entries = sorted(
+            (e for e in it if e.is_file() and e.name.endswith(".sql")),
+            key=lambda e: e.name,
+        )
+
+    hash_cache = load_hash_cache()
+
+    # Scripts never deployed always need hashing; only already-deployed scripts
+    # can be skipped on an unchanged cached fingerprint, without opening them
+    local_names = {os.path.splitext(entry.name)[0] for entry in sql_entries}
+    definitely_new = local_names - set(deployed_hashes)
+    possibly_changed = local_names & set(deployed_hashes)
+    unchanged_files = set()
+    for entry in sql_entries:
+        script_name = os.path.splitext(entry.name)[0]
+        if script_name in possibly_changed and (
+            lookup_cached_hash(entry, hash_cache) == deployed_hashes[script_name]
+        ):
+            unchanged_files.add(entry.name)
+
+    # Hash the rest up front; hashlib releases the GIL so threads overlap
+    with ThreadPoolExecutor(max_workers=HASH_MAX_WORKERS) as executor:
+        hash_futures = {
+            entry.name: executor.submit(
+                hash_and_cache_file
+                if os.path.splitext(entry.name)[0] in definitely_new
+                else get_cached_file_hash,
+                entry,
+                hash_cache,
+            )
+            for entry in sql_entries
+            if entry.name not in unchanged_files
+        }
+
+    # Drop entries for scripts that no longer exist before writing it back
+    local_paths = {entry.path for entry in sql_entries}
+    save_hash_cache({k: v for k, v in hash_cache.items() if k in local_paths})
+
+    for entry in sql_entries:
+        filename = entry.name
+        filepath = entry.path
+        script_name = os.path.splitext(filename)[0]
+
+        if filename in unchanged_files:
+            logging.info(f"Skipping '{filename}': No changes detected.")
+            skipped_count += 1
+            continue
+
+        try:
+            local_hash = hash_futures[filename].result()
+
+            if (
+                script_name in deployed_hashes
+                and deployed_hashes[script_name] == local_hash
+            ):
+                logging.info(f"Skipping '{filename}': No changes detected.")
+                skipped_count += 1
+                continue
+
+            logging.info(f"Deploying '{filename}' (New or changed).")
+            with open(filepath, "r", encoding="utf-8-sig") as file:
+                for i, stmt in enumerate(iter_statements(file), 1):
                     try:
                         cursor.execute(stmt)
-                        cnxn.commit()
-                        logging.info(f"Executed statement {i} from {filename}.")
+                        logging.debug(f"Executed statement {i} from {filename}.")
                     except Exception as e:
                         logging.error(f"Error in {filename}, statement {i}: {e}")
                         error_count += 1
                         cnxn.rollback()
                         break  # Stop executing further statements in this file
-
-                if error_count == 0:
-                    update_deployment_metadata(cursor, cnxn, script_name, local_hash)
+                else:
+                    # Commit the whole file as one transaction
+                    cnxn.commit()
+                    metadata_rows.append((script_name, local_hash))
                     logging.info(f"Successfully deployed: {filename}")
                     deployed_count += 1
 
-            except pyodbc.Error as ex:
-                logging.error(f"Error deploying {filename}: {ex}")
-                error_count += 1
-                cnxn.rollback()
-            except Exception as e:
-                logging.error(f"Unexpected error processing {filename}: {e}")
-                error_count += 1
-                cnxn.rollback()
+        except pyodbc.Error as ex:
+            logging.error(f"Error deploying {filename}: {ex}")
+            error_count += 1
+            cnxn.rollback()
+        except Exception as e:
+            logging.error(f"Unexpected error processing {filename}: {e}")
+            error_count += 1
+            cnxn.rollback()
+
+    update_deployment_metadata(cursor, cnxn, metadata_rows)
 
     cnxn.close()
     logging.info("--- Deployment Summary ---")